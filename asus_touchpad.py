@@ -2,17 +2,17 @@
 
 import importlib
 import logging
-import math
 import os
 import re
-import subprocess
+import struct
 import sys
-from fcntl import F_SETFL, fcntl
+from fcntl import F_SETFL, fcntl, ioctl
+from select import POLLIN, poll
 from time import sleep
 from typing import Optional
 
 import libevdev.const
-from libevdev import EV_ABS, EV_KEY, EV_SYN, Device, InputEvent
+from libevdev import EV_ABS, EV_KEY, EV_SYN, Device
 
 # Setup logging
 # LOG=DEBUG sudo -E ./asus-touchpad-numpad-driver  # all messages
@@ -38,6 +38,19 @@ device_id: Optional[str] = None
 
 tries = model_layout.try_times
 
+I2C_BUS_RE = re.compile(r".*i2c-(\d+)/.*$")
+TOUCHPAD_NAMES = ("Name=\"ASUE", "Name=\"ELAN")
+KEYBOARD_NAMES = ("Name=\"AT Translated Set 2 keyboard", "Name=\"Asus Keyboard")
+
+
+def is_touchpad(line):
+    return "Touchpad" in line and any(name in line for name in TOUCHPAD_NAMES)
+
+
+def is_keyboard(line):
+    return any(name in line for name in KEYBOARD_NAMES)
+
+
 # Look into the devices file #
 while tries > 0:
 
@@ -48,15 +61,14 @@ while tries > 0:
         lines = f.readlines()
         for line in lines:
             # Look for the touchpad #
-            if touchpad_detected == 0 and ("Name=\"ASUE" in line or "Name=\"ELAN" in line) and "Touchpad" in line:
+            if touchpad_detected == 0 and is_touchpad(line):
                 touchpad_detected = 1
                 log.debug('Detect touchpad from %s', line.strip())
 
             if touchpad_detected == 1:
                 if "S: " in line:
                     # search device id
-                    device_id = re.sub(r".*i2c-(\d+)/.*$",
-                                       r'\1', line).replace("\n", "")
+                    device_id = I2C_BUS_RE.sub(r'\1', line).replace("\n", "")
                     log.debug('Set touchpad device id %s from %s',
                               device_id, line.strip())
 
@@ -68,7 +80,7 @@ while tries > 0:
                               touchpad, line.strip())
 
             # Look for the keyboard (numlock) # AT Translated Set OR Asus Keyboard
-            if keyboard_detected == 0 and ("Name=\"AT Translated Set 2 keyboard" in line or "Name=\"Asus Keyboard" in line):
+            if keyboard_detected == 0 and is_keyboard(line):
                 keyboard_detected = 1
                 log.debug('Detect keyboard from %s', line.strip())
 
@@ -114,6 +126,17 @@ ai = d_t.absinfo[EV_ABS.ABS_Y]
 (miny, maxy) = (ai.minimum, ai.maximum)
 log.debug('Touchpad min-max: x %d-%d, y %d-%d', minx, maxx, miny, maxy)
 
+# Corner areas and position to key grid scales #
+
+NUMLOCK_X_THRESH = int(0.95 * maxx)
+NUMLOCK_Y_THRESH = int(0.09 * maxy)
+CUSTOM_X_THRESH = int(0.06 * maxx)
+CUSTOM_Y_THRESH = int(0.07 * maxy)
+
+COL_SCALE = model_layout.cols / (maxx + 1)
+ROW_SCALE = model_layout.rows / maxy
+TOP_OFFSET = model_layout.top_offset
+
 
 # Start monitoring the keyboard (numlock)
 
@@ -146,48 +169,110 @@ for col in model_layout.keys:
 if percentage_key != EV_KEY.KEY_5:
     dev.enable(percentage_key)
 
-udev = dev.create_uinput_device()
+# Open uinput ourselves so key events can be written straight to it #
+uinput_file = open('/dev/uinput', 'r+b', buffering=0)
+udev = dev.create_uinput_device(uinput_file)
+fd_u = uinput_file.fileno()
+
+# Flatten the layout, indexed by row * COLS + col, with the percentage key
+# already substituted #
+
+COLS = model_layout.cols
+ROWS = model_layout.rows
+KEYS_FLAT = tuple(
+    percentage_key if key == EV_KEY.KEY_5 else key
+    for row in model_layout.keys
+    for key in row
+)
+# Bit i is set when KEYS_FLAT[i] must be sent along with left shift #
+SHIFT_MASK = sum(
+    1 << i for i, key in enumerate(KEYS_FLAT) if key == percentage_key
+)
+
+# Key events are written in one go to uinput, so each press/release costs
+# a single write instead of one per event #
+
+INPUT_EVENT = struct.Struct('llHHi')
+
+
+def pack_events(*events):
+    return b''.join(INPUT_EVENT.pack(0, 0, code.type.value, code.value, value)
+                    for (code, value) in events)
+
+
+KEYS_DOWN_EVENTS = tuple(
+    (pack_events((EV_KEY.KEY_LEFTSHIFT, 1)) if (SHIFT_MASK >> i) & 1 else b'') +
+    pack_events((key, 1), (EV_SYN.SYN_REPORT, 0))
+    for i, key in enumerate(KEYS_FLAT)
+)
+KEYS_UP_EVENTS = tuple(
+    pack_events((EV_KEY.KEY_LEFTSHIFT, 0), (key, 0), (EV_SYN.SYN_REPORT, 0))
+    for key in KEYS_FLAT
+)
+
+
+# Open the numpad i2c device once, instead of spawning i2ctransfer on each
+# change. The address is already claimed by i2c_hid, hence the forced slave
+# (same as `i2ctransfer -f`)
+
+I2C_SLAVE_FORCE = 0x0706
+NUMPAD_I2C_ADDR = 0x15
+
+# If it cannot be opened, keep running without the numpad backlight #
+fd_i2c: Optional[int] = None
+try:
+    fd_i2c = os.open('/dev/i2c-' + device_id, os.O_RDWR)
+    ioctl(fd_i2c, I2C_SLAVE_FORCE, NUMPAD_I2C_ADDR)
+except OSError as err:
+    log.error("Cannot open numpad i2c device, %s", err)
+    if fd_i2c is not None:
+        os.close(fd_i2c)
+        fd_i2c = None
+
+
+def numpad_payload(value):
+    return bytes([0x05, 0x00, 0x3d, 0x03, 0x06, 0x00, 0x07,
+                  0x00, 0x0d, 0x14, 0x03, value, 0xad])
 
 
 # Brightness 31: Low, 24: Half, 1: Full
 
-BRIGHT_VAL = [hex(val) for val in [31, 24, 1]]
+BRIGHT_PAYLOADS = tuple(numpad_payload(val) for val in [31, 24, 1])
+OFF_PAYLOAD = numpad_payload(0x00)
+
+
+def set_numpad_backlight(payload):
+    if fd_i2c is None:
+        return
+    try:
+        os.write(fd_i2c, payload)
+    except OSError as err:
+        log.error("Cannot set numpad backlight, %s", err)
+
+
+NUMLOCK_ON_EVENTS = pack_events((EV_KEY.KEY_NUMLOCK, 1), (EV_SYN.SYN_REPORT, 0))
+NUMLOCK_OFF_EVENTS = pack_events((EV_KEY.KEY_NUMLOCK, 0), (EV_SYN.SYN_REPORT, 0))
+CUSTOM_ACTION_EVENTS = pack_events(
+    (custom_key, 1), (EV_SYN.SYN_REPORT, 0),
+    (custom_key, 0), (EV_SYN.SYN_REPORT, 0)
+)
 
 
 def activate_numlock(brightness):
-    numpad_cmd = "i2ctransfer -f -y " + device_id + \
-        " w13@0x15 0x05 0x00 0x3d 0x03 0x06 0x00 0x07 0x00 0x0d 0x14 0x03 " + \
-        BRIGHT_VAL[brightness] + " 0xad"
-    events = [
-        InputEvent(EV_KEY.KEY_NUMLOCK, 1),
-        InputEvent(EV_SYN.SYN_REPORT, 0)
-    ]
-    udev.send_events(events)
+    os.write(fd_u, NUMLOCK_ON_EVENTS)
     d_t.grab()
-    subprocess.call(numpad_cmd, shell=True)
+    set_numpad_backlight(BRIGHT_PAYLOADS[brightness])
 
 
 def deactivate_numlock():
-    numpad_cmd = "i2ctransfer -f -y " + device_id + \
-        " w13@0x15 0x05 0x00 0x3d 0x03 0x06 0x00 0x07 0x00 0x0d 0x14 0x03 0x00 0xad"
-    events = [
-        InputEvent(EV_KEY.KEY_NUMLOCK, 0),
-        InputEvent(EV_SYN.SYN_REPORT, 0)
-    ]
-    udev.send_events(events)
+    os.write(fd_u, NUMLOCK_OFF_EVENTS)
     d_t.ungrab()
-    subprocess.call(numpad_cmd, shell=True)
+    set_numpad_backlight(OFF_PAYLOAD)
 
 
 def launch_custom_action():
     try:
-        events = [
-            InputEvent(custom_key, 1),
-            InputEvent(EV_SYN.SYN_REPORT, 0),
-            InputEvent(custom_key, 0),
-            InputEvent(EV_SYN.SYN_REPORT, 0)
-        ]
-        udev.send_events(events)
+        os.write(fd_u, CUSTOM_ACTION_EVENTS)
     except OSError as e:
         pass
 
@@ -196,124 +281,132 @@ def launch_custom_action():
 # status 2 = middle bright
 # status 3 = max bright
 def change_brightness(brightness):
-    brightness = (brightness + 1) % len(BRIGHT_VAL)
-    numpad_cmd = "i2ctransfer -f -y " + device_id + \
-        " w13@0x15 0x05 0x00 0x3d 0x03 0x06 0x00 0x07 0x00 0x0d 0x14 0x03 " + \
-        BRIGHT_VAL[brightness] + " 0xad"
-    subprocess.call(numpad_cmd, shell=True)
+    brightness = (brightness + 1) % len(BRIGHT_PAYLOADS)
+    set_numpad_backlight(BRIGHT_PAYLOADS[brightness])
     return brightness
 
 
 # Run - process and act on events
 
-numlock: bool = False
-pos_x: int = 0
-pos_y: int = 0
-button_pressed: libevdev.const = None
-brightness: int = 0
-
-while True:
-    # If touchpad sends tap events, convert x/y position to numlock key and send it #
-    for e in d_t.events():
-
-        # ignore others events, except position and finger events
-        if not (
-            e.matches(EV_ABS.ABS_MT_POSITION_X) or
-            e.matches(EV_ABS.ABS_MT_POSITION_Y) or
-            e.matches(EV_KEY.BTN_TOOL_FINGER)
-        ):
+touchpad_poll = poll()
+touchpad_poll.register(fd_t, POLLIN)
+
+
+def main_loop():
+    numlock: bool = False
+    x: int = 0
+    y: int = 0
+    button_pressed: libevdev.const = None
+    button_index: int = 0
+    brightness: int = 0
+
+    # Bind the event types and codes used for every event to locals #
+    ev_abs = EV_ABS.value
+    ev_key = EV_KEY.value
+    abs_mt_position_x = EV_ABS.ABS_MT_POSITION_X.value
+    abs_mt_position_y = EV_ABS.ABS_MT_POSITION_Y.value
+    btn_tool_finger = EV_KEY.BTN_TOOL_FINGER.value
+    key_up, key_down = 0, 1
+
+    # The log level does not change while running #
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    # Events are read raw from the touchpad, bypassing the InputEvent objects
+    # libevdev would build for each of them #
+    fd = fd_t.fileno()
+    read_size = INPUT_EVENT.size * 64
+    iter_unpack = INPUT_EVENT.iter_unpack
+
+    while True:
+        # Wait for the touchpad to have events pending, then read them #
+        touchpad_poll.poll()
+        try:
+            buf = os.read(fd, read_size)
+        except BlockingIOError:
             continue
 
-        # Get x position #
-        if e.matches(EV_ABS.ABS_MT_POSITION_X):
-            x = e.value
-            continue
+        # If touchpad sends tap events, convert x/y position to numlock key and send it #
+        for (_, _, type_, code, value) in iter_unpack(buf):
 
-        # Get y position #
-        if e.matches(EV_ABS.ABS_MT_POSITION_Y):
-            y = e.value
-            continue
+            if type_ == ev_abs:
+                # Get x position #
+                if code == abs_mt_position_x:
+                    x = value
+                # Get y position #
+                elif code == abs_mt_position_y:
+                    y = value
+                continue
 
-        # Else event is tap: e.matches(EV_KEY.BTN_TOOL_FINGER) #
+            # ignore others events, except finger events #
+            if type_ != ev_key or code != btn_tool_finger:
+                continue
 
-        # If end of tap, send release key event #
-        if e.value == 0:
-            log.debug('finger up at x %d y %d', x, y)
+            # If end of tap, send release key event #
+            if value == key_up:
+                if debug:
+                    log.debug('finger up at x %d y %d', x, y)
+
+                if button_pressed:
+                    if debug:
+                        log.debug('send key up event %s', button_pressed)
+                    try:
+                        os.write(fd_u, KEYS_UP_EVENTS[button_index])
+                        button_pressed = None
+                    except OSError as err:
+                        log.error("Cannot send release event, %s", err)
+                        pass
+
+            elif value == key_down and not button_pressed:
+                # Start of tap #
+                if debug:
+                    log.debug('finger down at x %d y %d', x, y)
+
+                # Check if numlock was hit #
+                if (x > NUMLOCK_X_THRESH) and (y < NUMLOCK_Y_THRESH):
+                    numlock = not numlock
+                    if numlock:
+                        activate_numlock(brightness)
+                    else:
+                        deactivate_numlock()
+                    continue
+
+                # Check if custom key was hit #
+                elif (x < CUSTOM_X_THRESH) and (y < CUSTOM_Y_THRESH):
+                    if numlock:
+                        brightness = change_brightness(brightness)
+                    else:
+                        launch_custom_action()
+                    continue
+
+                # If touchpad mode, ignore #
+                if not numlock:
+                    continue
+
+                # else numpad mode is activated
+                col = int(x * COL_SCALE)
+                row_pos = y * ROW_SCALE - TOP_OFFSET
+                # Ignore top_offset region #
+                if row_pos < 0:
+                    continue
+                row = int(row_pos)
+                # skip invalid row and col values
+                if row >= ROWS or col >= COLS:
+                    if debug:
+                        log.debug(
+                            'Unhandled col/row %d/%d for position %d-%d', col, row, x, y)
+                    continue
 
-            if button_pressed:
-                log.debug('send key up event %s', button_pressed)
-                events = [
-                    InputEvent(EV_KEY.KEY_LEFTSHIFT, 0),
-                    InputEvent(button_pressed, 0),
-                    InputEvent(EV_SYN.SYN_REPORT, 0)
-                ]
-                try:
-                    udev.send_events(events)
-                    button_pressed = None
-                except OSError as err:
-                    log.error("Cannot send release event, %s", err)
-                    pass
-
-        elif e.value == 1 and not button_pressed:
-            # Start of tap #
-            log.debug('finger down at x %d y %d', x, y)
-
-            # Check if numlock was hit #
-            if (x > 0.95 * maxx) and (y < 0.09 * maxy):
-                numlock = not numlock
-                if numlock:
-                    activate_numlock(brightness)
-                else:
-                    deactivate_numlock()
-                continue
+                button_index = row * COLS + col
+                button_pressed = KEYS_FLAT[button_index]
 
-            # Check if custom key was hit #
-            elif (x < 0.06 * maxx) and (y < 0.07 * maxy):
-                if numlock:
-                    brightness = change_brightness(brightness)
-                else:
-                    launch_custom_action()
-                continue
+                # Send press key event #
+                if debug:
+                    log.debug('send press key event %s', button_pressed)
 
-            # If touchpad mode, ignore #
-            if not numlock:
-                continue
+                try:
+                    os.write(fd_u, KEYS_DOWN_EVENTS[button_index])
+                except OSError as err:
+                    log.warning("Cannot send press event, %s", err)
 
-            # else numpad mode is activated
-            col = math.floor(model_layout.cols * x / (maxx+1))
-            row = math.floor((model_layout.rows * y / maxy) -
-                             model_layout.top_offset)
-            # Ignore top_offset region #
-            if row < 0:
-                continue
-            try:
-                button_pressed = model_layout.keys[row][col]
-            except IndexError:
-                # skip invalid row and col values
-                log.debug(
-                    'Unhandled col/row %d/%d for position %d-%d', col, row, x, y)
-                continue
 
-            if button_pressed == EV_KEY.KEY_5:
-                button_pressed = percentage_key
-
-            # Send press key event #
-            log.debug('send press key event %s', button_pressed)
-
-            if button_pressed == percentage_key:
-                events = [
-                    InputEvent(EV_KEY.KEY_LEFTSHIFT, 1),
-                    InputEvent(button_pressed, 1),
-                    InputEvent(EV_SYN.SYN_REPORT, 0)
-                ]
-            else:
-                events = [
-                    InputEvent(button_pressed, 1),
-                    InputEvent(EV_SYN.SYN_REPORT, 0)
-                ]
-
-            try:
-                udev.send_events(events)
-            except OSError as err:
-                log.warning("Cannot send press event, %s", err)
-    sleep(0.1)
+main_loop()